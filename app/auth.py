@@ -1,11 +1,126 @@
 from fastapi import HTTPException, Security, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from datetime import datetime, timezone
-from bson import ObjectId
-from .database import get_database
-from .models import verify_api_key
+from pymongo import UpdateOne
+from pymongo.errors import PyMongoError
+from datetime import datetime, timedelta, timezone
+import asyncio
+import re
+from .database import get_database, get_cached_api_key, cache_api_key, api_key_cache_generation
+from .models import hash_api_key, DEFAULT_HASH_ALGO
+
+# Missing credentials fall through to get_current_api_key so they get a 401
+security = HTTPBearer(auto_error=False)
+
+# Shape of keys issued by generate_api_key(); anything else is rejected before hashing
+_KEY_RE = re.compile(r"^[A-Za-z0-9_\-]{32,64}$")
+
+# last_used is persisted at most once per interval per key; uses in between
+# are kept in memory and written by flush_last_used()
+LAST_USED_WRITE_INTERVAL = timedelta(seconds=60)
+_last_used_cache = {}
+_pending_last_used = {}
+
+# last_used writes run in the background; past this many in flight, further
+# uses are left for flush_last_used() instead of starting more writes
+MAX_LAST_USED_WRITES = 100
+_last_used_writes = set()
+
+
+async def _write_last_used(db, key_id, timestamp: datetime) -> None:
+    try:
+        await db.api_keys.update_one(
+            {"_id": key_id},
+            {"$set": {"last_used": timestamp}}
+        )
+    except PyMongoError as e:
+        print(f"Error updating last_used for API key {key_id}: {e}")
+
+
+def touch_last_used(db, key_id) -> None:
+    """
+    Records a use of the API key. The database write happens in the
+    background, and only if the previous write for this key is older than
+    LAST_USED_WRITE_INTERVAL.
+    """
+    now = datetime.now(timezone.utc)
+    last_written = _last_used_cache.get(key_id)
+    
+    if (last_written and now - last_written < LAST_USED_WRITE_INTERVAL) or \
+            len(_last_used_writes) >= MAX_LAST_USED_WRITES:
+        _pending_last_used[key_id] = now
+        return
+    
+    _last_used_cache[key_id] = now
+    _pending_last_used.pop(key_id, None)
+    task = asyncio.create_task(_write_last_used(db, key_id, now))
+    _last_used_writes.add(task)
+    task.add_done_callback(_last_used_writes.discard)
+
+
+def _requeue_last_used(pending: dict) -> None:
+    # Keep the timestamps for the next flush unless a newer use replaced them
+    for key_id, ts in pending.items():
+        _pending_last_used.setdefault(key_id, ts)
+
+
+async def flush_last_used() -> None:
+    """
+    Waits for background last_used writes, then writes the timestamps that
+    were debounced by touch_last_used.
+    """
+    if _last_used_writes:
+        await asyncio.gather(*_last_used_writes)
+    
+    if not _pending_last_used:
+        return
+    
+    pending = dict(_pending_last_used)
+    _pending_last_used.clear()
+    _last_used_cache.update(pending)
+    
+    try:
+        await get_database().api_keys.bulk_write(
+            [UpdateOne({"_id": key_id}, {"$set": {"last_used": ts}}) for key_id, ts in pending.items()],
+            ordered=False
+        )
+    except PyMongoError as e:
+        _requeue_last_used(pending)
+        print(f"Error flushing last_used for {len(pending)} API keys: {e}")
+    except asyncio.CancelledError:
+        _requeue_last_used(pending)
+        raise
+
+
+async def flush_last_used_periodically() -> None:
+    """
+    Flushes debounced last_used timestamps every LAST_USED_WRITE_INTERVAL, so
+    a key used in a burst and then left idle still gets its last use recorded.
+    """
+    while True:
+        await asyncio.sleep(LAST_USED_WRITE_INTERVAL.total_seconds())
+        await flush_last_used()
+
+
+async def _find_legacy_api_key(db, api_key: str, key_hash: str):
+    """
+    Looks up a key stored under its legacy SHA-256 hash and rehashes it with
+    the default algorithm, so the next authentication takes the fast path.
+    """
+    legacy_hash = hash_api_key(api_key, "sha256")
+    key_doc = await db.api_keys.find_one({"key_hash": legacy_hash, "is_active": True})
+    if key_doc is None:
+        return None
+    
+    try:
+        await db.api_keys.update_one(
+            {"_id": key_doc["_id"], "key_hash": legacy_hash},
+            {"$set": {"key_hash": key_hash, "hash_algo": DEFAULT_HASH_ALGO}}
+        )
+        key_doc.update(key_hash=key_hash, hash_algo=DEFAULT_HASH_ALGO)
+    except PyMongoError as e:
+        print(f"Error rehashing legacy API key {key_doc['_id']}: {e}")
+    return key_doc
 
-security = HTTPBearer()
 
 async def get_current_api_key(credentials: HTTPAuthorizationCredentials = Security(security)) -> dict:
     """
@@ -28,17 +143,31 @@ async def get_current_api_key(credentials: HTTPAuthorizationCredentials = Securi
             headers={"WWW-Authenticate": "Bearer"},
         )
     
+    if not _KEY_RE.match(api_key):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid or expired API key",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    
     db = get_database()
     
-    # Find all active API keys and check against the provided key
-    async for key_doc in db.api_keys.find({"is_active": True}):
-        if verify_api_key(api_key, key_doc["key_hash"]):
-            # Update last_used timestamp
-            await db.api_keys.update_one(
-                {"_id": key_doc["_id"]},
-                {"$set": {"last_used": datetime.now(timezone.utc)}}
-            )
-            return key_doc
+    key_hash = hash_api_key(api_key)
+    # Keys prefetched at startup are served without touching the database
+    key_doc = get_cached_api_key(key_hash)
+    
+    if key_doc is None:
+        generation = api_key_cache_generation()
+        key_doc = await db.api_keys.find_one({"key_hash": key_hash, "is_active": True})
+        if key_doc is None:
+            # Keys created before BLAKE3 are still stored under SHA-256
+            key_doc = await _find_legacy_api_key(db, api_key, key_hash)
+        if key_doc:
+            cache_api_key(key_hash, key_doc, generation)
+    
+    if key_doc:
+        touch_last_used(db, key_doc["_id"])
+        return key_doc
     
     raise HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
@@ -1,18 +1,46 @@
 from motor.motor_asyncio import AsyncIOMotorClient
 from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo.errors import OperationFailure, PyMongoError
+from cachetools import TTLCache
+import asyncio
 import os
 
 MONGO_URL = os.getenv("MONGO_URL", "mongodb://localhost:27017")
 DATABASE_NAME = os.getenv("DATABASE_NAME", "user_db")
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "200"))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "20"))
+MONGO_COMPRESSORS = os.getenv("MONGO_COMPRESSORS", "zstd,zlib")
+# Without a change stream, other workers keep serving a revoked key for up to this many seconds
+API_KEY_CACHE_TTL = int(os.getenv("API_KEY_CACHE_TTL", "30"))
 
 class MongoDB:
     client: AsyncIOMotorClient = None
     database: AsyncIOMotorDatabase = None
+    # Active API keys by key_hash, kept current by watch_api_keys()
+    api_key_map: dict = {}
+    api_key_watcher: asyncio.Task = None
 
 mongodb = MongoDB()
 
+# Active key documents by key hash, so repeated authentications skip the database
+_api_key_cache = TTLCache(maxsize=1024, ttl=API_KEY_CACHE_TTL)
+# Bumped on every invalidation, so a lookup that raced one doesn't cache a stale document
+_api_key_cache_generation = 0
+
+# Change streams are only available on replica sets and sharded clusters
+CHANGE_STREAM_UNSUPPORTED = 40573
+WATCH_RETRY_MAX_DELAY = 60
+
 async def connect_to_mongo():
-    mongodb.client = AsyncIOMotorClient(MONGO_URL)
+    # Keep warm connections for bursts and compress traffic to the server
+    mongodb.client = AsyncIOMotorClient(
+        MONGO_URL,
+        maxPoolSize=MONGO_MAX_POOL_SIZE,
+        minPoolSize=MONGO_MIN_POOL_SIZE,
+        compressors=MONGO_COMPRESSORS,
+        serverSelectionTimeoutMS=2000,
+        retryWrites=True
+    )
     mongodb.database = mongodb.client[DATABASE_NAME]
     
     try:
@@ -20,8 +48,97 @@ async def connect_to_mongo():
         print("Successfully connected to MongoDB")
     except Exception as e:
         print(f"Error connecting to MongoDB: {e}")
+        return
+    
+    # The unique indexes are what keep emails and key hashes unique, so a failed
+    # build (e.g. existing duplicates) must stop startup instead of being logged
+    await create_indexes(mongodb.database)
+    mongodb.api_key_watcher = asyncio.create_task(watch_api_keys())
+
+async def create_indexes(database: AsyncIOMotorDatabase):
+    # Auth looks keys up by hash, so make it a single indexed point lookup
+    await database.api_keys.create_index("key_hash", unique=True)
+    await database.users.create_index("email", unique=True)
+
+def invalidate_cached_api_key(key_id) -> None:
+    """
+    Drops a key from the authentication caches after it is updated or deleted.
+    """
+    global _api_key_cache_generation
+    _api_key_cache_generation += 1
+    for cache in (_api_key_cache, mongodb.api_key_map):
+        for key_hash, key_doc in list(cache.items()):
+            if key_doc["_id"] == key_id:
+                cache.pop(key_hash, None)
+
+def get_cached_api_key(key_hash: str):
+    """
+    Returns the active key document for a hash from the change-stream map or
+    the TTL cache, or None if neither holds it.
+    """
+    return mongodb.api_key_map.get(key_hash) or _api_key_cache.get(key_hash)
+
+def api_key_cache_generation() -> int:
+    return _api_key_cache_generation
+
+def cache_api_key(key_hash: str, key_doc: dict, generation: int) -> None:
+    """
+    Caches a key document read from the database, unless a key was invalidated
+    since the lookup started at the given generation.
+    """
+    if generation == _api_key_cache_generation:
+        _api_key_cache[key_hash] = key_doc
+
+async def load_api_keys():
+    # Legacy SHA-256 rows can't be found by their BLAKE3 hash; they join the
+    # map through the change stream once authentication rehashes them
+    mongodb.api_key_map = {
+        doc["key_hash"]: doc
+        async for doc in mongodb.database.api_keys.find({"is_active": True, "hash_algo": "blake3"})
+    }
+
+def apply_api_key_change(change: dict):
+    if change["operationType"] not in ("insert", "update", "replace", "delete"):
+        # Collection dropped or renamed
+        mongodb.api_key_map = {}
+        return
+    
+    invalidate_cached_api_key(change["documentKey"]["_id"])
+    
+    doc = change.get("fullDocument")
+    if doc and doc.get("is_active") and doc.get("hash_algo") == "blake3":
+        mongodb.api_key_map[doc["key_hash"]] = doc
+
+async def watch_api_keys():
+    # Change streams need a replica set; without one the map stays empty
+    # and authentication falls back to querying the database
+    delay = 1
+    while True:
+        try:
+            async with mongodb.database.api_keys.watch(full_document="updateLookup") as stream:
+                # Load after the stream is open so no change is missed in between
+                await load_api_keys()
+                delay = 1
+                async for change in stream:
+                    apply_api_key_change(change)
+        except OperationFailure as e:
+            if e.code == CHANGE_STREAM_UNSUPPORTED:
+                print(f"API key change stream unavailable: {e}")
+                mongodb.api_key_map = {}
+                return
+            print(f"API key change stream failed, retrying in {delay}s: {e}")
+        except PyMongoError as e:
+            print(f"API key change stream failed, retrying in {delay}s: {e}")
+        
+        # Changes are missed while the stream is down, so stop serving from the map
+        mongodb.api_key_map = {}
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, WATCH_RETRY_MAX_DELAY)
 
 def close_mongo_connection():
+    if mongodb.api_key_watcher:
+        mongodb.api_key_watcher.cancel()
+        mongodb.api_key_watcher = None
     if mongodb.client:
         mongodb.client.close()
         print("MongoDB connection closed")
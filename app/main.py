@@ -1,23 +1,40 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Response
 from contextlib import asynccontextmanager
+import asyncio
+import orjson
 from .database import connect_to_mongo, close_mongo_connection
 from .routes import router
+from .auth import flush_last_used, flush_last_used_periodically
+from .responses import ORJSONResponse
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     await connect_to_mongo()
-    yield
-    await close_mongo_connection()
+    flusher = asyncio.create_task(flush_last_used_periodically())
+    try:
+        yield
+    finally:
+        # Let an interrupted flush requeue its timestamps before the final one
+        flusher.cancel()
+        await asyncio.gather(flusher, return_exceptions=True)
+        try:
+            await flush_last_used()
+        finally:
+            close_mongo_connection()
 
 app = FastAPI(
     title="User API",
     description="API REST para gerenciar usuários com FastAPI e MongoDB",
     version="1.0.0",
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
 )
 
 app.include_router(router, prefix="/api/v1")
 
+# Health check body is constant, so serialize it once
+_ROOT_BODY = orjson.dumps({"message": "User API is running!"})
+
 @app.get("/")
 async def root():
-    return {"message": "User API is running!"}
\ No newline at end of file
+    return Response(content=_ROOT_BODY, media_type="application/json")
\ No newline at end of file
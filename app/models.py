@@ -2,17 +2,30 @@ from pydantic import BaseModel, EmailStr, Field, ConfigDict, field_validator, fi
 from pydantic.json_schema import JsonSchemaValue
 from pydantic_core import core_schema
 from datetime import date, datetime
-from typing import Optional, Annotated, Any
+from typing import Optional, Annotated, Any, List
 from bson import ObjectId
-import secrets
+from bson.errors import InvalidId
+import base64
+import os
 import hashlib
+import hmac
+import blake3
 
 
 class PyObjectId(ObjectId):
+    _core_schema: Optional[core_schema.CoreSchema] = None
+
     @classmethod
     def __get_pydantic_core_schema__(
         cls, source_type: Any, handler
     ) -> core_schema.CoreSchema:
+        # The schema is the same for every field, so build it only once
+        if cls._core_schema is None:
+            cls._core_schema = cls._build_core_schema()
+        return cls._core_schema
+
+    @classmethod
+    def _build_core_schema(cls) -> core_schema.CoreSchema:
         return core_schema.json_or_python_schema(
             json_schema=core_schema.str_schema(),
             python_schema=core_schema.union_schema([
@@ -29,9 +42,13 @@ class PyObjectId(ObjectId):
 
     @classmethod
     def validate(cls, v):
-        if not ObjectId.is_valid(v):
+        # Already an ObjectId: return it as is rather than copying it
+        if isinstance(v, ObjectId):
+            return v
+        try:
+            return ObjectId(v)
+        except (InvalidId, TypeError):
             raise ValueError("Invalid ObjectId")
-        return ObjectId(v)
 
     @classmethod
     def __get_pydantic_json_schema__(
@@ -61,8 +78,7 @@ class UserResponse(UserBase):
 
     model_config = ConfigDict(
         populate_by_name=True,
-        arbitrary_types_allowed=True,
-        json_encoders={ObjectId: str}
+        arbitrary_types_allowed=True
     )
 
     @field_serializer('data_nascimento')
@@ -72,13 +88,27 @@ class UserResponse(UserBase):
         return value
 
 
+class UserPage(BaseModel):
+    items: List[UserResponse]
+    next_cursor: Optional[str] = Field(None, description="Pass as cursor to fetch the next page")
+
+
+class UserBulkError(BaseModel):
+    index: int = Field(..., description="Position of the user in the request body")
+    detail: str
+
+
+class UserBulkResponse(BaseModel):
+    items: List[UserResponse]
+    errors: List[UserBulkError]
+
+
 class UserInDB(UserBase):
     id: PyObjectId = Field(default_factory=PyObjectId, alias="_id")
 
     model_config = ConfigDict(
         populate_by_name=True,
-        arbitrary_types_allowed=True,
-        json_encoders={ObjectId: str}
+        arbitrary_types_allowed=True
     )
 
 
@@ -106,21 +136,25 @@ class APIKeyResponse(APIKeyBase):
 
     model_config = ConfigDict(
         populate_by_name=True,
-        arbitrary_types_allowed=True,
-        json_encoders={ObjectId: str}
+        arbitrary_types_allowed=True
     )
 
 
+class APIKeyPage(BaseModel):
+    items: List[APIKeyResponse]
+    next_cursor: Optional[str] = Field(None, description="Pass as cursor to fetch the next page")
+
+
 class APIKeyInDB(APIKeyBase):
     id: PyObjectId = Field(default_factory=PyObjectId, alias="_id")
-    key_hash: str = Field(..., description="SHA256 hash of the API key")
+    key_hash: str = Field(..., description="BLAKE3 hash of the API key")
+    hash_algo: str = Field(default="sha256", description="Algorithm used for key_hash")
     created_at: datetime
     last_used: Optional[datetime] = None
 
     model_config = ConfigDict(
         populate_by_name=True,
-        arbitrary_types_allowed=True,
-        json_encoders={ObjectId: str}
+        arbitrary_types_allowed=True
     )
 
 
@@ -129,12 +163,25 @@ class APIKeyCreated(APIKeyResponse):
 
 
 def generate_api_key() -> str:
-    return secrets.token_urlsafe(32)
+    # Same output as secrets.token_urlsafe(32), without the extra indirection
+    return base64.urlsafe_b64encode(os.urandom(32)).rstrip(b"=").decode("ascii")
+
+
+# Keys created before the switch to BLAKE3 are stored as SHA-256 hashes
+HASH_ALGORITHMS = {
+    "blake3": lambda data: blake3.blake3(data).hexdigest(),
+    "sha256": lambda data: hashlib.sha256(data).hexdigest(),
+}
+DEFAULT_HASH_ALGO = "blake3"
 
 
-def hash_api_key(key: str) -> str:
-    return hashlib.sha256(key.encode()).hexdigest()
+def hash_api_key(key: str, algo: str = DEFAULT_HASH_ALGO) -> str:
+    return HASH_ALGORITHMS[algo](key.encode())
 
 
-def verify_api_key(key: str, key_hash: str) -> bool:
-    return hashlib.sha256(key.encode()).hexdigest() == key_hash
\ No newline at end of file
+def verify_api_key(
+    key: str, key_hash: str, algo: str = DEFAULT_HASH_ALGO, precomputed_hash: Optional[str] = None
+) -> bool:
+    # Pass precomputed_hash when the caller already hashed the key
+    candidate = precomputed_hash if precomputed_hash is not None else hash_api_key(key, algo)
+    return hmac.compare_digest(candidate, key_hash)
\ No newline at end of file
@@ -0,0 +1,13 @@
+from fastapi import responses
+from bson import ObjectId
+import orjson
+
+def _orjson_default(obj):
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+class ORJSONResponse(responses.ORJSONResponse):
+    """ORJSONResponse that also serializes ObjectId values."""
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, default=_orjson_default, option=orjson.OPT_NON_STR_KEYS)
\ No newline at end of file
@@ -1,14 +1,18 @@
-from fastapi import APIRouter, HTTPException, status, Security
-from typing import List
+from fastapi import APIRouter, Body, HTTPException, Query, status, Security
+from typing import List, Optional
 from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 from datetime import datetime, timezone
 from .models import (
-    UserCreate, UserUpdate, UserResponse,
-    APIKeyCreate, APIKeyUpdate, APIKeyResponse, APIKeyCreated,
-    generate_api_key, hash_api_key
+    UserCreate, UserUpdate, UserResponse, UserPage, UserBulkResponse,
+    APIKeyCreate, APIKeyUpdate, APIKeyResponse, APIKeyCreated, APIKeyPage,
+    generate_api_key, hash_api_key, DEFAULT_HASH_ALGO
 )
-from .database import get_database
+from .database import get_database, invalidate_cached_api_key
 from .auth import verify_api_key_dependency
+from .responses import ORJSONResponse
 
 router = APIRouter()
 
@@ -18,6 +22,70 @@ INVALID_API_KEY_ID_FORMAT = "Invalid API key ID format"
 API_KEY_NOT_FOUND = "API key not found"
 INVALID_USER_ID_FORMAT = "Invalid user ID format"
 USER_NOT_FOUND = "User not found"
+EMAIL_ALREADY_REGISTERED = "Email already registered"
+INVALID_CURSOR_FORMAT = "Invalid cursor format"
+
+# Page size limits for list endpoints
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+MAX_BULK_USERS = 500
+
+# data_nascimento is stored as a datetime at midnight
+_MIDNIGHT = datetime.min.time()
+DUPLICATE_KEY_ERROR_CODE = 11000
+
+# Fields read from the database for list responses
+API_KEY_LIST_PROJECTION = {"key_hash": 0}
+USER_PROJECTION = {"nome": 1, "email": 1, "data_nascimento": 1}
+
+
+# List endpoints serialize documents straight to JSON; the data was validated
+# on the way in, so per-item Pydantic validation is skipped
+def _shape_api_key(key_doc: dict) -> dict:
+    return {
+        "_id": key_doc["_id"],
+        "name": key_doc["name"],
+        "description": key_doc.get("description"),
+        "is_active": key_doc["is_active"],
+        "key_preview": key_doc.get("key_preview", KEY_PREVIEW_PLACEHOLDER),
+        "created_at": key_doc["created_at"],
+        "last_used": key_doc.get("last_used")
+    }
+
+
+def _to_oid(value: str, detail: str) -> ObjectId:
+    # Parses the id once per request instead of is_valid() plus ObjectId()
+    try:
+        return ObjectId(value)
+    except (InvalidId, TypeError):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=detail
+        )
+
+
+def _page_query(cursor: Optional[str]) -> dict:
+    # Pages are ordered by _id descending; the cursor is the last _id seen
+    if cursor is None:
+        return {}
+    return {"_id": {"$lt": _to_oid(cursor, INVALID_CURSOR_FORMAT)}}
+
+
+def _page_response(items: list, limit: int) -> ORJSONResponse:
+    next_cursor = str(items[-1]["_id"]) if len(items) == limit else None
+    return ORJSONResponse({"items": items, "next_cursor": next_cursor})
+
+
+def _shape_user(user: dict) -> dict:
+    data_nascimento = user["data_nascimento"]
+    if isinstance(data_nascimento, datetime):
+        data_nascimento = data_nascimento.date()
+    return {
+        "_id": user["_id"],
+        "nome": user["nome"],
+        "email": user["email"],
+        "data_nascimento": data_nascimento
+    }
 
 @router.post("/api-keys", response_model=APIKeyCreated, status_code=status.HTTP_201_CREATED, tags=["api-keys"])
 async def create_api_key(api_key: APIKeyCreate):
@@ -34,48 +102,43 @@ async def create_api_key(api_key: APIKeyCreate):
         "description": api_key.description,
         "is_active": api_key.is_active,
         "key_hash": key_hash,
+        "hash_algo": DEFAULT_HASH_ALGO,
         "created_at": datetime.now(timezone.utc),
         "last_used": None
     }
     
     # Insert into database
     result = await db.api_keys.insert_one(api_key_data)
-    
-    # Get the created API key
-    created_api_key = await db.api_keys.find_one({"_id": result.inserted_id})
+    api_key_data["_id"] = result.inserted_id
     
     # Return response with the actual key (only shown once)
     return APIKeyCreated(
-        **created_api_key,
+        **api_key_data,
         key_preview=key[:8] + "..." + key[-4:],
         key=key
     )
 
 
-@router.get("/api-keys", response_model=List[APIKeyResponse], tags=["api-keys"])
-async def get_api_keys(api_key_data: dict = Security(verify_api_key_dependency)):
-    """List all API keys"""
+@router.get("/api-keys", response_model=APIKeyPage, tags=["api-keys"])
+async def get_api_keys(
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    api_key_data: dict = Security(verify_api_key_dependency)
+):
+    """List API keys, newest first"""
     db = get_database()
-    api_keys = []
-    async for key_doc in db.api_keys.find().sort("created_at", -1):
-        api_keys.append(APIKeyResponse(
-            **key_doc,
-            key_preview=key_doc.get("key_preview", KEY_PREVIEW_PLACEHOLDER)
-        ))
-    return api_keys
+    docs = db.api_keys.find(_page_query(cursor), projection=API_KEY_LIST_PROJECTION).sort("_id", -1).limit(limit)
+    api_keys = [_shape_api_key(key_doc) for key_doc in await docs.to_list(length=limit)]
+    return _page_response(api_keys, limit)
 
 
 @router.get("/api-keys/{key_id}", response_model=APIKeyResponse, tags=["api-keys"])
 async def get_api_key(key_id: str, api_key_data: dict = Security(verify_api_key_dependency)):
     """Get a specific API key"""
-    if not ObjectId.is_valid(key_id):
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail=INVALID_API_KEY_ID_FORMAT
-        )
+    key_oid = _to_oid(key_id, INVALID_API_KEY_ID_FORMAT)
     
     db = get_database()
-    key_doc = await db.api_keys.find_one({"_id": ObjectId(key_id)})
+    key_doc = await db.api_keys.find_one({"_id": key_oid})
     
     if not key_doc:
         raise HTTPException(
@@ -92,30 +155,28 @@ async def get_api_key(key_id: str, api_key_data: dict = Security(verify_api_key_
 @router.put("/api-keys/{key_id}", response_model=APIKeyResponse, tags=["api-keys"])
 async def update_api_key(key_id: str, api_key_update: APIKeyUpdate, api_key_data: dict = Security(verify_api_key_dependency)):
     """Update an API key"""
-    if not ObjectId.is_valid(key_id):
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail=INVALID_API_KEY_ID_FORMAT
-        )
+    key_oid = _to_oid(key_id, INVALID_API_KEY_ID_FORMAT)
     
     db = get_database()
     
-    existing_key = await db.api_keys.find_one({"_id": ObjectId(key_id)})
-    if not existing_key:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail=API_KEY_NOT_FOUND
-        )
-    
     update_data = {k: v for k, v in api_key_update.model_dump().items() if v is not None}
     
     if update_data:
-        await db.api_keys.update_one(
-            {"_id": ObjectId(key_id)},
-            {"$set": update_data}
+        updated_key = await db.api_keys.find_one_and_update(
+            {"_id": key_oid},
+            {"$set": update_data},
+            return_document=ReturnDocument.AFTER
+        )
+        invalidate_cached_api_key(key_oid)
+    else:
+        updated_key = await db.api_keys.find_one({"_id": key_oid})
+    
+    if not updated_key:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=API_KEY_NOT_FOUND
         )
     
-    updated_key = await db.api_keys.find_one({"_id": ObjectId(key_id)})
     return APIKeyResponse(
         **updated_key,
         key_preview=updated_key.get("key_preview", "********")
@@ -125,15 +186,11 @@ async def update_api_key(key_id: str, api_key_update: APIKeyUpdate, api_key_data
 @router.delete("/api-keys/{key_id}", status_code=status.HTTP_204_NO_CONTENT, tags=["api-keys"])
 async def delete_api_key(key_id: str, api_key_data: dict = Security(verify_api_key_dependency)):
     """Delete an API key"""
-    if not ObjectId.is_valid(key_id):
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail=INVALID_API_KEY_ID_FORMAT
-        )
+    key_oid = _to_oid(key_id, INVALID_API_KEY_ID_FORMAT)
     
     db = get_database()
     
-    result = await db.api_keys.delete_one({"_id": ObjectId(key_id)})
+    result = await db.api_keys.delete_one({"_id": key_oid})
     
     if result.deleted_count == 0:
         raise HTTPException(
@@ -141,6 +198,8 @@ async def delete_api_key(key_id: str, api_key_data: dict = Security(verify_api_k
             detail=API_KEY_NOT_FOUND
         )
     
+    invalidate_cached_api_key(key_oid)
+    
     return None
 
 
@@ -148,42 +207,71 @@ async def delete_api_key(key_id: str, api_key_data: dict = Security(verify_api_k
 async def create_user(user: UserCreate, api_key_data: dict = Security(verify_api_key_dependency)):
     db = get_database()
     
-    existing_user = await db.users.find_one({"email": user.email})
-    if existing_user:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Email already registered"
-        )
-    
     user_dict = user.model_dump()
     # Convert date to datetime for MongoDB compatibility
     if "data_nascimento" in user_dict and user_dict["data_nascimento"]:
-        from datetime import datetime
-        user_dict["data_nascimento"] = datetime.combine(user_dict["data_nascimento"], datetime.min.time())
+        user_dict["data_nascimento"] = datetime.combine(user_dict["data_nascimento"], _MIDNIGHT)
+    
+    # Email uniqueness is enforced by the unique index on users.email
+    try:
+        await db.users.insert_one(user_dict)
+    except DuplicateKeyError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=EMAIL_ALREADY_REGISTERED
+        )
     
-    result = await db.users.insert_one(user_dict)
+    # insert_one sets the generated _id on user_dict
+    return UserResponse(**user_dict)
+
+@router.post("/users/bulk", response_model=UserBulkResponse, status_code=status.HTTP_201_CREATED, tags=["users"])
+async def create_users(
+    users: List[UserCreate] = Body(..., min_length=1, max_length=MAX_BULK_USERS),
+    api_key_data: dict = Security(verify_api_key_dependency)
+):
+    """Create several users in one write; users with a taken email are reported in errors"""
+    db = get_database()
     
-    created_user = await db.users.find_one({"_id": result.inserted_id})
-    return UserResponse(**created_user)
+    user_dicts = []
+    for user in users:
+        user_dict = user.model_dump()
+        # Convert date to datetime for MongoDB compatibility
+        user_dict["data_nascimento"] = datetime.combine(user_dict["data_nascimento"], _MIDNIGHT)
+        user_dicts.append(user_dict)
+    
+    # Unordered, so one duplicate email does not stop the remaining inserts
+    errors = []
+    try:
+        await db.users.insert_many(user_dicts, ordered=False)
+    except BulkWriteError as e:
+        for write_error in e.details["writeErrors"]:
+            duplicate = write_error["code"] == DUPLICATE_KEY_ERROR_CODE
+            errors.append({
+                "index": write_error["index"],
+                "detail": EMAIL_ALREADY_REGISTERED if duplicate else write_error["errmsg"]
+            })
+    
+    failed = {error["index"] for error in errors}
+    items = [_shape_user(user_dict) for i, user_dict in enumerate(user_dicts) if i not in failed]
+    return ORJSONResponse({"items": items, "errors": errors}, status_code=status.HTTP_201_CREATED)
 
-@router.get("/users", response_model=List[UserResponse], tags=["users"])
-async def get_users(api_key_data: dict = Security(verify_api_key_dependency)):
+@router.get("/users", response_model=UserPage, tags=["users"])
+async def get_users(
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    api_key_data: dict = Security(verify_api_key_dependency)
+):
     db = get_database()
-    users = []
-    async for user in db.users.find():
-        users.append(UserResponse(**user))
-    return users
+    docs = db.users.find(_page_query(cursor), projection=USER_PROJECTION).sort("_id", -1).limit(limit)
+    users = [_shape_user(user) for user in await docs.to_list(length=limit)]
+    return _page_response(users, limit)
 
 @router.get("/users/{user_id}", response_model=UserResponse, tags=["users"])
 async def get_user(user_id: str, api_key_data: dict = Security(verify_api_key_dependency)):
-    if not ObjectId.is_valid(user_id):
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail=INVALID_USER_ID_FORMAT
-        )
+    user_oid = _to_oid(user_id, INVALID_USER_ID_FORMAT)
     
     db = get_database()
-    user = await db.users.find_one({"_id": ObjectId(user_id)})
+    user = await db.users.find_one({"_id": user_oid})
     
     if not user:
         raise HTTPException(
@@ -195,59 +283,46 @@ async def get_user(user_id: str, api_key_data: dict = Security(verify_api_key_de
 
 @router.put("/users/{user_id}", response_model=UserResponse, tags=["users"])
 async def update_user(user_id: str, user_update: UserUpdate, api_key_data: dict = Security(verify_api_key_dependency)):
-    if not ObjectId.is_valid(user_id):
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail=INVALID_USER_ID_FORMAT
-        )
+    user_oid = _to_oid(user_id, INVALID_USER_ID_FORMAT)
     
     db = get_database()
     
-    existing_user = await db.users.find_one({"_id": ObjectId(user_id)})
-    if not existing_user:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail=USER_NOT_FOUND
-        )
-    
     update_data = {k: v for k, v in user_update.model_dump().items() if v is not None}
     
     # Convert date to datetime for MongoDB compatibility
     if "data_nascimento" in update_data and update_data["data_nascimento"]:
-        from datetime import datetime
-        update_data["data_nascimento"] = datetime.combine(update_data["data_nascimento"], datetime.min.time())
-    
-    if "email" in update_data:
-        email_exists = await db.users.find_one({
-            "email": update_data["email"],
-            "_id": {"$ne": ObjectId(user_id)}
-        })
-        if email_exists:
+        update_data["data_nascimento"] = datetime.combine(update_data["data_nascimento"], _MIDNIGHT)
+    
+    if update_data:
+        try:
+            updated_user = await db.users.find_one_and_update(
+                {"_id": user_oid},
+                {"$set": update_data},
+                return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
-                detail="Email already registered"
+                detail=EMAIL_ALREADY_REGISTERED
             )
+    else:
+        updated_user = await db.users.find_one({"_id": user_oid})
     
-    if update_data:
-        await db.users.update_one(
-            {"_id": ObjectId(user_id)},
-            {"$set": update_data}
+    if not updated_user:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=USER_NOT_FOUND
         )
     
-    updated_user = await db.users.find_one({"_id": ObjectId(user_id)})
     return UserResponse(**updated_user)
 
 @router.delete("/users/{user_id}", status_code=status.HTTP_204_NO_CONTENT, tags=["users"])
 async def delete_user(user_id: str, api_key_data: dict = Security(verify_api_key_dependency)):
-    if not ObjectId.is_valid(user_id):
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail=INVALID_USER_ID_FORMAT
-        )
+    user_oid = _to_oid(user_id, INVALID_USER_ID_FORMAT)
     
     db = get_database()
     
-    result = await db.users.delete_one({"_id": ObjectId(user_id)})
+    result = await db.users.delete_one({"_id": user_oid})
     
     if result.deleted_count == 0:
         raise HTTPException(
@@ -1,58 +1,145 @@
+import os
+
+# Motor sizes its executor at import time; the suite issues many tiny queries,
+# where a single worker thread beats the default of five per CPU
+os.environ.setdefault("MOTOR_MAX_WORKERS", "1")
+
 import pytest
+import pytest_asyncio
+from pytest_asyncio import is_async_test
 import asyncio
-from fastapi.testclient import TestClient
-from httpx import AsyncClient
+from fastapi import FastAPI
+from httpx import AsyncClient, ASGITransport
 from motor.motor_asyncio import AsyncIOMotorClient
 from app.main import app
-from app.database import mongodb
+from app.database import mongodb, create_indexes, _api_key_cache
+from app.auth import _last_used_cache, _pending_last_used, verify_api_key_dependency
+from app.routes import router
+from app.responses import ORJSONResponse
 from app.models import generate_api_key, hash_api_key
-from datetime import datetime
-import os
+from datetime import datetime, timezone
+import itertools
+import orjson
+import zlib
+from uuid import uuid4
+
+class ORJSONAsyncClient(AsyncClient):
+    """AsyncClient that encodes json= request bodies with orjson."""
+    
+    def build_request(self, method, url, *, json=None, content=None, headers=None, **kwargs):
+        if json is not None:
+            content = orjson.dumps(json)
+            headers = {**(headers or {}), "content-type": "application/json"}
+        return super().build_request(method, url, content=content, headers=headers, **kwargs)
+
+# Shared timestamp for inserted test documents
+_NOW = datetime.now(timezone.utc)
 
 # Test database configuration
-TEST_DATABASE_NAME = "test_user_db"
+# Each pytest-xdist worker gets its own database so parallel tests don't collide
+TEST_DATABASE_NAME = f"test_user_db_{os.getenv('PYTEST_XDIST_WORKER', 'gw0')}"
 MONGO_URL = os.getenv("MONGO_URL", "mongodb://localhost:27017")
+# MONGO_FAKE=1 runs the suite against an in-process mongomock database
+MONGO_FAKE = os.getenv("MONGO_FAKE") == "1"
 
-@pytest.fixture(scope="session")
-def event_loop():
-    """Create an instance of the default event loop for the test session."""
-    loop = asyncio.get_event_loop_policy().new_event_loop()
-    yield loop
-    loop.close()
+def pytest_collection_modifyitems(items):
+    """Run every async test on the session event loop shared with the fixtures."""
+    session_loop = pytest.mark.asyncio(loop_scope="session")
+    for item in items:
+        if is_async_test(item):
+            item.add_marker(session_loop, append=False)
 
-@pytest.fixture
-async def test_db():
-    """Create a test database connection."""
-    client = AsyncIOMotorClient(MONGO_URL)
+@pytest_asyncio.fixture(scope="session")
+async def indexed_db():
+    """Connect to the test database and create its indexes once per session."""
+    if MONGO_FAKE:
+        from mongomock_motor import AsyncMongoMockClient
+        client = AsyncMongoMockClient()
+    else:
+        # Open connections up front so the first tests don't pay for pool warm-up
+        client = AsyncIOMotorClient(MONGO_URL, maxPoolSize=20, minPoolSize=5)
     db = client[TEST_DATABASE_NAME]
-    
-    # Override the database connection for tests
-    mongodb.client = client
-    mongodb.database = db
+    await create_indexes(db)
     
     yield db
     
-    # Clean up: drop all collections after each test
-    collections = await db.list_collection_names()
-    for collection_name in collections:
-        await db.drop_collection(collection_name)
-    
+    await client.drop_database(TEST_DATABASE_NAME)
     client.close()
 
-@pytest.fixture
-def client():
-    """Create a test client."""
-    return TestClient(app)
+@pytest_asyncio.fixture(scope="session")
+async def is_replica_set(indexed_db):
+    """Whether the test server can run transactions, checked once per session."""
+    if MONGO_FAKE:
+        return False
+    info = await indexed_db.client.admin.command("hello")
+    return "setName" in info
 
 @pytest.fixture
+async def test_db(indexed_db, test_api_key):
+    """Create a test database connection."""
+    # Start each test from empty collections, except for the session API key, which is
+    # restored to its original document; delete_many keeps the session's indexes
+    key_doc = test_api_key["data"]
+    await asyncio.gather(
+        indexed_db.api_keys.delete_many({"_id": {"$ne": key_doc["_id"]}}),
+        indexed_db.api_keys.replace_one({"_id": key_doc["_id"]}, dict(key_doc), upsert=True),
+        indexed_db.users.delete_many({})
+    )
+    
+    # Override the database connection for tests
+    mongodb.client = indexed_db.client
+    mongodb.database = indexed_db
+    
+    yield indexed_db
+
+@pytest.fixture(autouse=True)
+def reset_auth_caches():
+    """Clear in-process auth state so pooled keys don't resolve to an earlier test's document."""
+    yield
+    _api_key_cache.clear()
+    _last_used_cache.clear()
+    _pending_last_used.clear()
+    mongodb.api_key_map = {}
+
+@pytest_asyncio.fixture(scope="session")
 async def async_client():
-    """Create an async test client."""
-    async with AsyncClient(app=app, base_url="http://test") as ac:
+    """Create an async test client shared by the whole session."""
+    async with ORJSONAsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
         yield ac
 
+@pytest_asyncio.fixture(scope="session")
+async def validation_client():
+    """Async client for request validation tests that never reach MongoDB."""
+    # Same routes without the Mongo lifespan; auth is stubbed so no key lookup is made
+    app_no_db = FastAPI(default_response_class=ORJSONResponse)
+    app_no_db.include_router(router, prefix="/api/v1")
+    app_no_db.dependency_overrides[verify_api_key_dependency] = lambda: {}
+    async with ORJSONAsyncClient(transport=ASGITransport(app=app_no_db), base_url="http://test") as ac:
+        yield ac
+
+API_KEY_POOL_SIZE = 50
+
+@pytest.fixture(scope="session")
+def api_key_pool():
+    """Pre-generate (key, key_hash) pairs once for the whole session."""
+    keys = [generate_api_key() for _ in range(API_KEY_POOL_SIZE)]
+    return [(key, hash_api_key(key)) for key in keys]
+
 @pytest.fixture
-async def test_api_key(test_db):
-    """Create a test API key."""
+def take_api_key(request, api_key_pool):
+    """Hand out distinct pooled (key, key_hash) pairs within a test."""
+    # crc32 rather than hash() so the starting point is stable across runs
+    offsets = itertools.count(zlib.crc32(request.node.nodeid.encode()))
+    
+    def take():
+        return api_key_pool[next(offsets) % len(api_key_pool)]
+    
+    return take
+
+@pytest_asyncio.fixture(scope="session")
+async def test_api_key(indexed_db):
+    """Create a test API key shared by the whole session."""
+    # Generated outside the pool so pooled keys can never collide with it
     key = generate_api_key()
     key_hash = hash_api_key(key)
     
@@ -61,11 +148,11 @@ async def test_api_key(test_db):
         "description": "Test description",
         "is_active": True,
         "key_hash": key_hash,
-        "created_at": datetime.utcnow(),
+        "created_at": _NOW,
         "last_used": None
     }
     
-    result = await test_db.api_keys.insert_one(api_key_data)
+    result = await indexed_db.api_keys.insert_one(api_key_data)
     api_key_data["_id"] = result.inserted_id
     
     return {
@@ -76,7 +163,30 @@ async def test_api_key(test_db):
     }
 
 @pytest.fixture
-async def auth_headers(test_api_key):
+def bulk_insert_keys(test_db, take_api_key):
+    """Insert several API keys with a single insert_many call."""
+    async def insert(n, **overrides):
+        pairs = [take_api_key() for _ in range(n)]
+        keys = [key for key, _ in pairs]
+        docs = [
+            {
+                "name": f"Test API Key {i}",
+                "description": f"Test description {i}",
+                "is_active": True,
+                "key_hash": key_hash,
+                "created_at": _NOW,
+                "last_used": None,
+                **overrides
+            }
+            for i, (_, key_hash) in enumerate(pairs)
+        ]
+        result = await test_db.api_keys.insert_many(docs)
+        return [{"key": key, "id": key_id} for key, key_id in zip(keys, result.inserted_ids)]
+    
+    return insert
+
+@pytest.fixture(scope="session")
+def auth_headers(test_api_key):
     """Create authentication headers with test API key."""
     return {"Authorization": f"Bearer {test_api_key['key']}"}
 
@@ -85,7 +195,7 @@ def test_user_data():
     """Sample user data for testing."""
     return {
         "nome": "João Silva",
-        "email": "joao@email.com",
+        "email": f"joao_{uuid4().hex}@email.com",
         "data_nascimento": "1990-01-15"
     }
 
@@ -1,9 +1,16 @@
 import pytest
+import asyncio
 from fastapi import status
 from httpx import AsyncClient
 from bson import ObjectId
-from datetime import datetime
-from app.models import generate_api_key, hash_api_key
+from datetime import datetime, timezone
+from uuid import uuid4
+from app.auth import flush_last_used
+
+# Shared timestamp for inserted test documents
+_NOW = datetime.now(timezone.utc)
+# Well-formed id that never matches a stored document
+_FAKE_ID = str(ObjectId())
 
 class TestHealthEndpoint:
     """Test health check endpoint."""
@@ -49,11 +56,12 @@ class TestAPIKeyEndpoints:
         assert data["description"] is None
         assert data["is_active"] is True
     
-    async def test_create_api_key_invalid_name(self, async_client: AsyncClient, test_db):
+    @pytest.mark.validation
+    async def test_create_api_key_invalid_name(self, validation_client: AsyncClient):
         """Test creating API key with invalid name."""
         api_key_data = {"name": ""}
         
-        response = await async_client.post("/api/v1/api-keys", json=api_key_data)
+        response = await validation_client.post("/api/v1/api-keys", json=api_key_data)
         assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
     
     async def test_get_api_keys(self, async_client: AsyncClient, test_db, auth_headers):
@@ -62,8 +70,34 @@ class TestAPIKeyEndpoints:
         assert response.status_code == status.HTTP_200_OK
         
         data = response.json()
-        assert isinstance(data, list)
-        assert len(data) >= 1  # At least the test API key
+        assert isinstance(data["items"], list)
+        assert len(data["items"]) >= 1  # At least the test API key
+        assert data["next_cursor"] is None
+    
+    async def test_get_api_keys_pagination(self, async_client: AsyncClient, test_db, auth_headers):
+        """Test paging through API keys with a cursor."""
+        for i in range(2):
+            response = await async_client.post("/api/v1/api-keys", json={"name": f"Paged Key {i}"})
+            assert response.status_code == status.HTTP_201_CREATED
+        
+        response = await async_client.get("/api/v1/api-keys?limit=2", headers=auth_headers)
+        assert response.status_code == status.HTTP_200_OK
+        first_page = response.json()
+        assert [key["name"] for key in first_page["items"]] == ["Paged Key 1", "Paged Key 0"]
+        assert first_page["next_cursor"] == first_page["items"][-1]["_id"]
+        
+        response = await async_client.get(
+            f"/api/v1/api-keys?limit=2&cursor={first_page['next_cursor']}", headers=auth_headers
+        )
+        assert response.status_code == status.HTTP_200_OK
+        second_page = response.json()
+        assert [key["name"] for key in second_page["items"]] == ["Test API Key"]
+        assert second_page["next_cursor"] is None
+    
+    async def test_get_api_keys_invalid_cursor(self, async_client: AsyncClient, test_db, auth_headers):
+        """Test listing API keys with an invalid cursor."""
+        response = await async_client.get("/api/v1/api-keys?cursor=invalid", headers=auth_headers)
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
     
     async def test_get_api_keys_unauthorized(self, async_client: AsyncClient, test_db):
         """Test listing API keys without authentication."""
@@ -77,12 +111,11 @@ class TestAPIKeyEndpoints:
         
         data = response.json()
         assert data["name"] == "Test API Key"
-        assert data["id"] == test_api_key['id']
+        assert data["_id"] == test_api_key['id']
     
     async def test_get_api_key_not_found(self, async_client: AsyncClient, test_db, auth_headers):
         """Test getting non-existent API key."""
-        fake_id = str(ObjectId())
-        response = await async_client.get(f"/api/v1/api-keys/{fake_id}", headers=auth_headers)
+        response = await async_client.get(f"/api/v1/api-keys/{_FAKE_ID}", headers=auth_headers)
         assert response.status_code == status.HTTP_404_NOT_FOUND
     
     async def test_get_api_key_invalid_id(self, async_client: AsyncClient, test_db, auth_headers):
@@ -106,23 +139,21 @@ class TestAPIKeyEndpoints:
     
     async def test_update_api_key_not_found(self, async_client: AsyncClient, test_db, auth_headers):
         """Test updating non-existent API key."""
-        fake_id = str(ObjectId())
         update_data = {"name": "Updated Name"}
         
-        response = await async_client.put(f"/api/v1/api-keys/{fake_id}", json=update_data, headers=auth_headers)
+        response = await async_client.put(f"/api/v1/api-keys/{_FAKE_ID}", json=update_data, headers=auth_headers)
         assert response.status_code == status.HTTP_404_NOT_FOUND
     
-    async def test_delete_api_key(self, async_client: AsyncClient, test_db, auth_headers):
+    async def test_delete_api_key(self, async_client: AsyncClient, test_db, auth_headers, take_api_key):
         """Test deleting an API key."""
         # Create a key to delete
-        key = generate_api_key()
-        key_hash = hash_api_key(key)
+        key, key_hash = take_api_key()
         
         api_key_data = {
             "name": "Key to Delete",
             "key_hash": key_hash,
             "is_active": True,
-            "created_at": datetime.utcnow(),
+            "created_at": _NOW,
             "last_used": None
         }
         
@@ -133,13 +164,11 @@ class TestAPIKeyEndpoints:
         assert response.status_code == status.HTTP_204_NO_CONTENT
         
         # Verify it's deleted
-        deleted_key = await test_db.api_keys.find_one({"_id": result.inserted_id})
-        assert deleted_key is None
+        assert await test_db.api_keys.count_documents({"_id": result.inserted_id}, limit=1) == 0
     
     async def test_delete_api_key_not_found(self, async_client: AsyncClient, test_db, auth_headers):
         """Test deleting non-existent API key."""
-        fake_id = str(ObjectId())
-        response = await async_client.delete(f"/api/v1/api-keys/{fake_id}", headers=auth_headers)
+        response = await async_client.delete(f"/api/v1/api-keys/{_FAKE_ID}", headers=auth_headers)
         assert response.status_code == status.HTTP_404_NOT_FOUND
 
 class TestUserEndpoints:
@@ -154,7 +183,7 @@ class TestUserEndpoints:
         assert data["nome"] == test_user_data["nome"]
         assert data["email"] == test_user_data["email"]
         assert data["data_nascimento"] == test_user_data["data_nascimento"]
-        assert "id" in data
+        assert "_id" in data
     
     async def test_create_user_duplicate_email(self, async_client: AsyncClient, test_db, auth_headers, test_user_data):
         """Test creating user with duplicate email."""
@@ -166,7 +195,30 @@ class TestUserEndpoints:
         assert response.status_code == status.HTTP_400_BAD_REQUEST
         assert "Email already registered" in response.json()["detail"]
     
-    async def test_create_user_invalid_email(self, async_client: AsyncClient, test_db, auth_headers):
+    async def test_create_users_bulk(self, async_client: AsyncClient, test_db, auth_headers, test_user_data):
+        """Test creating several users in one request."""
+        users = [
+            test_user_data,
+            {"nome": "Second User", "email": "second@email.com", "data_nascimento": "1985-05-20"},
+            test_user_data
+        ]
+        
+        response = await async_client.post("/api/v1/users/bulk", json=users, headers=auth_headers)
+        assert response.status_code == status.HTTP_201_CREATED
+        
+        data = response.json()
+        assert [user["email"] for user in data["items"]] == [test_user_data["email"], "second@email.com"]
+        assert data["items"][1]["data_nascimento"] == "1985-05-20"
+        assert data["errors"] == [{"index": 2, "detail": "Email already registered"}]
+        assert await test_db.users.count_documents({}) == 2
+    
+    async def test_create_users_bulk_empty(self, async_client: AsyncClient, test_db, auth_headers):
+        """Test that an empty bulk request is rejected."""
+        response = await async_client.post("/api/v1/users/bulk", json=[], headers=auth_headers)
+        assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+    
+    @pytest.mark.validation
+    async def test_create_user_invalid_email(self, validation_client: AsyncClient):
         """Test creating user with invalid email."""
         invalid_user_data = {
             "nome": "Test User",
@@ -174,7 +226,7 @@ class TestUserEndpoints:
             "data_nascimento": "1990-01-15"
         }
         
-        response = await async_client.post("/api/v1/users", json=invalid_user_data, headers=auth_headers)
+        response = await validation_client.post("/api/v1/users", json=invalid_user_data)
         assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
     
     async def test_create_user_unauthorized(self, async_client: AsyncClient, test_db, test_user_data):
@@ -188,13 +240,18 @@ class TestUserEndpoints:
         assert response.status_code == status.HTTP_200_OK
         
         data = response.json()
-        assert isinstance(data, list)
-        assert len(data) >= 1
+        assert isinstance(data["items"], list)
+        assert len(data["items"]) >= 1
         
         # Check that our created user is in the list
-        user_emails = [user["email"] for user in data]
+        user_emails = [user["email"] for user in data["items"]]
         assert created_user["email"] in user_emails
     
+    async def test_get_users_limit_too_large(self, async_client: AsyncClient, test_db, auth_headers):
+        """Test that the page size is capped."""
+        response = await async_client.get("/api/v1/users?limit=1000", headers=auth_headers)
+        assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+    
     async def test_get_users_unauthorized(self, async_client: AsyncClient, test_db):
         """Test listing users without authentication."""
         response = await async_client.get("/api/v1/users")
@@ -209,12 +266,11 @@ class TestUserEndpoints:
         data = response.json()
         assert data["nome"] == created_user["nome"]
         assert data["email"] == created_user["email"]
-        assert data["id"] == user_id
+        assert data["_id"] == user_id
     
     async def test_get_user_not_found(self, async_client: AsyncClient, test_db, auth_headers):
         """Test getting non-existent user."""
-        fake_id = str(ObjectId())
-        response = await async_client.get(f"/api/v1/users/{fake_id}", headers=auth_headers)
+        response = await async_client.get(f"/api/v1/users/{_FAKE_ID}", headers=auth_headers)
         assert response.status_code == status.HTTP_404_NOT_FOUND
     
     async def test_get_user_invalid_id(self, async_client: AsyncClient, test_db, auth_headers):
@@ -253,7 +309,8 @@ class TestUserEndpoints:
         """Test updating user with duplicate email."""
         # Create two users
         response1 = await async_client.post("/api/v1/users", json=test_user_data, headers=auth_headers)
-        user1_id = response1.json()["id"]
+        d1 = response1.json()
+        user1_id = d1["_id"]
         
         user2_data = {
             "nome": "Second User",
@@ -261,7 +318,9 @@ class TestUserEndpoints:
             "data_nascimento": "1985-05-20"
         }
         response2 = await async_client.post("/api/v1/users", json=user2_data, headers=auth_headers)
-        user2_id = response2.json()["id"]
+        d2 = response2.json()
+        user2_id = d2["_id"]
+        assert user1_id != user2_id
         
         # Try to update user2 with user1's email
         update_data = {"email": test_user_data["email"]}
@@ -271,10 +330,9 @@ class TestUserEndpoints:
     
     async def test_update_user_not_found(self, async_client: AsyncClient, test_db, auth_headers):
         """Test updating non-existent user."""
-        fake_id = str(ObjectId())
         update_data = {"nome": "Updated Name"}
         
-        response = await async_client.put(f"/api/v1/users/{fake_id}", json=update_data, headers=auth_headers)
+        response = await async_client.put(f"/api/v1/users/{_FAKE_ID}", json=update_data, headers=auth_headers)
         assert response.status_code == status.HTTP_404_NOT_FOUND
     
     async def test_delete_user(self, async_client: AsyncClient, test_db, auth_headers, created_user):
@@ -284,13 +342,11 @@ class TestUserEndpoints:
         assert response.status_code == status.HTTP_204_NO_CONTENT
         
         # Verify it's deleted
-        deleted_user = await test_db.users.find_one({"_id": created_user["_id"]})
-        assert deleted_user is None
+        assert await test_db.users.count_documents({"_id": created_user["_id"]}, limit=1) == 0
     
     async def test_delete_user_not_found(self, async_client: AsyncClient, test_db, auth_headers):
         """Test deleting non-existent user."""
-        fake_id = str(ObjectId())
-        response = await async_client.delete(f"/api/v1/users/{fake_id}", headers=auth_headers)
+        response = await async_client.delete(f"/api/v1/users/{_FAKE_ID}", headers=auth_headers)
         assert response.status_code == status.HTTP_404_NOT_FOUND
     
     async def test_delete_user_unauthorized(self, async_client: AsyncClient, test_db, created_user):
@@ -319,57 +375,55 @@ class TestAPIIntegration:
         }
         response = await async_client.post("/api/v1/users", json=user_data, headers=headers)
         assert response.status_code == status.HTTP_201_CREATED
-        user_id = response.json()["id"]
+        user_id = response.json()["_id"]
         
-        # 3. Get user
-        response = await async_client.get(f"/api/v1/users/{user_id}", headers=headers)
-        assert response.status_code == status.HTTP_200_OK
+        # 3. Get and list users concurrently
+        get_task = asyncio.create_task(async_client.get(f"/api/v1/users/{user_id}", headers=headers))
+        list_task = asyncio.create_task(async_client.get("/api/v1/users", headers=headers))
+        get_response, list_response = await asyncio.gather(get_task, list_task)
+        assert get_response.status_code == status.HTTP_200_OK
+        assert list_response.status_code == status.HTTP_200_OK
         
         # 4. Update user
         update_data = {"nome": "Updated Workflow User"}
         response = await async_client.put(f"/api/v1/users/{user_id}", json=update_data, headers=headers)
         assert response.status_code == status.HTTP_200_OK
         
-        # 5. List users
-        response = await async_client.get("/api/v1/users", headers=headers)
-        assert response.status_code == status.HTTP_200_OK
-        
-        # 6. Delete user
+        # 5. Delete user
         response = await async_client.delete(f"/api/v1/users/{user_id}", headers=headers)
         assert response.status_code == status.HTTP_204_NO_CONTENT
     
     async def test_concurrent_requests(self, async_client: AsyncClient, test_db, auth_headers):
         """Test handling concurrent requests."""
-        import asyncio
-        
         async def create_user(i):
             user_data = {
                 "nome": f"Concurrent User {i}",
-                "email": f"concurrent{i}@email.com",
+                "email": f"concurrent_{uuid4().hex}@email.com",
                 "data_nascimento": "1990-01-01"
             }
             return await async_client.post("/api/v1/users", json=user_data, headers=auth_headers)
         
         # Create multiple users concurrently
-        tasks = [create_user(i) for i in range(5)]
-        responses = await asyncio.gather(*tasks)
+        async with asyncio.TaskGroup() as tg:
+            tasks = [tg.create_task(create_user(i)) for i in range(5)]
         
         # All should succeed
-        for response in responses:
-            assert response.status_code == status.HTTP_201_CREATED
+        for task in tasks:
+            assert task.result().status_code == status.HTTP_201_CREATED
     
     async def test_api_key_usage_tracking(self, async_client: AsyncClient, test_db, test_api_key, auth_headers):
         """Test that API key usage is tracked."""
-        # Get initial last_used
-        initial_key = await test_db.api_keys.find_one({"key_hash": test_api_key["key_hash"]})
+        # Get initial last_used, fetching only that field
+        initial_key = await test_db.api_keys.find_one({"key_hash": test_api_key["key_hash"]}, {"last_used": 1, "_id": 0})
         initial_last_used = initial_key.get("last_used")
         
         # Make an API call
         response = await async_client.get("/api/v1/users", headers=auth_headers)
         assert response.status_code == status.HTTP_200_OK
+        await flush_last_used()
         
         # Check that last_used was updated
-        updated_key = await test_db.api_keys.find_one({"key_hash": test_api_key["key_hash"]})
+        updated_key = await test_db.api_keys.find_one({"key_hash": test_api_key["key_hash"]}, {"last_used": 1, "_id": 0})
         updated_last_used = updated_key.get("last_used")
         
         assert updated_last_used != initial_last_used
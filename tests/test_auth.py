@@ -1,9 +1,18 @@
 import pytest
+import asyncio
 from fastapi import HTTPException
 from fastapi.security import HTTPAuthorizationCredentials
-from datetime import datetime
-from app.auth import get_current_api_key, verify_api_key_dependency
-from app.models import hash_api_key, generate_api_key
+from datetime import datetime, timedelta, timezone
+from app.auth import (
+    get_current_api_key, verify_api_key_dependency, flush_last_used,
+    flush_last_used_periodically, _pending_last_used
+)
+from pymongo.errors import AutoReconnect
+from app.models import hash_api_key
+from app.database import apply_api_key_change, invalidate_cached_api_key
+
+# Shared timestamp for inserted test documents
+_NOW = datetime.now(timezone.utc)
 
 class TestAuthentication:
     """Test authentication functionality."""
@@ -56,18 +65,30 @@ class TestAuthentication:
         assert exc_info.value.status_code == 401
         assert "Invalid API key format" in str(exc_info.value.detail)
     
-    async def test_get_current_api_key_inactive(self, test_db):
+    async def test_get_current_api_key_malformed(self):
+        """Test malformed keys are rejected before any database lookup."""
+        credentials = HTTPAuthorizationCredentials(
+            scheme="Bearer",
+            credentials="not a valid key!"
+        )
+        
+        with pytest.raises(HTTPException) as exc_info:
+            await get_current_api_key(credentials)
+        
+        assert exc_info.value.status_code == 401
+        assert "Invalid or expired API key" in str(exc_info.value.detail)
+    
+    async def test_get_current_api_key_inactive(self, test_db, take_api_key):
         """Test get_current_api_key with inactive API key."""
         # Create inactive API key
-        key = generate_api_key()
-        key_hash = hash_api_key(key)
+        key, key_hash = take_api_key()
         
         api_key_data = {
             "name": "Inactive API Key",
             "description": "Inactive key for testing",
             "is_active": False,  # Inactive
             "key_hash": key_hash,
-            "created_at": datetime.utcnow(),
+            "created_at": _NOW,
             "last_used": None
         }
         
@@ -84,6 +105,30 @@ class TestAuthentication:
         assert exc_info.value.status_code == 401
         assert "Invalid or expired API key" in str(exc_info.value.detail)
     
+    async def test_legacy_sha256_key_is_rehashed(self, test_db, take_api_key):
+        """Test a legacy SHA-256 key authenticates and is migrated to BLAKE3."""
+        key, key_hash = take_api_key()
+        
+        result = await test_db.api_keys.insert_one({
+            "name": "Legacy API Key",
+            "is_active": True,
+            "key_hash": hash_api_key(key, "sha256"),
+            "hash_algo": "sha256",
+            "created_at": _NOW,
+            "last_used": None
+        })
+        
+        credentials = HTTPAuthorizationCredentials(
+            scheme="Bearer",
+            credentials=key
+        )
+        
+        key_doc = await get_current_api_key(credentials)
+        assert key_doc["_id"] == result.inserted_id
+        
+        stored = await test_db.api_keys.find_one({"_id": result.inserted_id}, {"key_hash": 1, "hash_algo": 1, "_id": 0})
+        assert stored == {"key_hash": key_hash, "hash_algo": "blake3"}
+    
     async def test_get_current_api_key_updates_last_used(self, test_db, test_api_key):
         """Test that get_current_api_key updates last_used timestamp."""
         credentials = HTTPAuthorizationCredentials(
@@ -92,30 +137,162 @@ class TestAuthentication:
         )
         
         # Get initial state
-        initial_key = await test_db.api_keys.find_one({"_id": test_api_key["data"]["_id"]})
+        initial_key = await test_db.api_keys.find_one({"_id": test_api_key["data"]["_id"]}, {"last_used": 1, "_id": 0})
         initial_last_used = initial_key.get("last_used")
         
-        # Authenticate
+        # Authenticate and wait for the background last_used write
         await get_current_api_key(credentials)
+        await flush_last_used()
         
         # Check that last_used was updated
-        updated_key = await test_db.api_keys.find_one({"_id": test_api_key["data"]["_id"]})
+        updated_key = await test_db.api_keys.find_one({"_id": test_api_key["data"]["_id"]}, {"last_used": 1, "_id": 0})
         updated_last_used = updated_key.get("last_used")
         
         assert updated_last_used is not None
         assert updated_last_used != initial_last_used
         assert isinstance(updated_last_used, datetime)
     
-    async def test_verify_api_key_dependency_valid(self, test_db, test_api_key):
-        """Test verify_api_key_dependency with valid API key."""
+    async def test_last_used_writes_are_debounced(self, test_db, test_api_key):
+        """Test that repeated authentications write last_used only once per interval."""
+        credentials = HTTPAuthorizationCredentials(
+            scheme="Bearer",
+            credentials=test_api_key["key"]
+        )
+        key_id = test_api_key["data"]["_id"]
+        
+        await get_current_api_key(credentials)
+        await flush_last_used()
+        first_key = await test_db.api_keys.find_one({"_id": key_id})
+        
+        # Second use within the interval is kept in memory only
+        await get_current_api_key(credentials)
+        second_key = await test_db.api_keys.find_one({"_id": key_id})
+        assert second_key["last_used"] == first_key["last_used"]
+        assert key_id in _pending_last_used
+        
+        # Flushing persists the pending timestamp
+        await flush_last_used()
+        assert key_id not in _pending_last_used
+        flushed_key = await test_db.api_keys.find_one({"_id": key_id})
+        assert flushed_key["last_used"] is not None
+    
+    async def test_flush_last_used_keeps_pending_on_error(self, test_db, test_api_key, monkeypatch):
+        """Test that a failed flush is logged and retried by the next one."""
+        key_id = test_api_key["data"]["_id"]
+        _pending_last_used[key_id] = _NOW
+        
+        class FailingCollection:
+            async def bulk_write(self, *args, **kwargs):
+                raise AutoReconnect("connection reset")
+        
+        class FakeDatabase:
+            api_keys = FailingCollection()
+        
+        monkeypatch.setattr("app.auth.get_database", FakeDatabase)
+        await flush_last_used()
+        assert _pending_last_used[key_id] == _NOW
+        
+        monkeypatch.undo()
+        await flush_last_used()
+        assert key_id not in _pending_last_used
+    
+    async def test_pending_last_used_flushed_periodically(self, test_db, test_api_key, monkeypatch):
+        """Test that debounced timestamps are written without waiting for shutdown."""
+        key_id = test_api_key["data"]["_id"]
+        _pending_last_used[key_id] = _NOW
+        monkeypatch.setattr("app.auth.LAST_USED_WRITE_INTERVAL", timedelta(seconds=0))
+        
+        flusher = asyncio.create_task(flush_last_used_periodically())
+        try:
+            for _ in range(100):
+                if key_id not in _pending_last_used:
+                    break
+                await asyncio.sleep(0.01)
+        finally:
+            flusher.cancel()
+            await asyncio.gather(flusher, return_exceptions=True)
+        
+        stored = await test_db.api_keys.find_one({"_id": key_id})
+        assert stored["last_used"] is not None
+    
+    async def test_api_key_served_from_cache(self, test_db, test_api_key):
+        """Test that repeated authentications are served from the cache."""
         credentials = HTTPAuthorizationCredentials(
             scheme="Bearer",
             credentials=test_api_key["key"]
         )
         
-        # Mock the dependency call
-        api_key_data = await get_current_api_key(credentials)
-        result = await verify_api_key_dependency(api_key_data)
+        await get_current_api_key(credentials)
+        
+        # Deleting directly in the database is not seen until invalidation
+        await test_db.api_keys.delete_one({"_id": test_api_key["data"]["_id"]})
+        result = await get_current_api_key(credentials)
+        assert result["_id"] == test_api_key["data"]["_id"]
+        
+        invalidate_cached_api_key(test_api_key["data"]["_id"])
+        with pytest.raises(HTTPException) as exc_info:
+            await get_current_api_key(credentials)
+        
+        assert exc_info.value.status_code == 401
+    
+    async def test_key_deleted_during_lookup_is_not_cached(self, test_db, test_api_key, monkeypatch):
+        """Test that a lookup racing a delete doesn't cache the deleted key."""
+        credentials = HTTPAuthorizationCredentials(
+            scheme="Bearer",
+            credentials=test_api_key["key"]
+        )
+        key_id = test_api_key["data"]["_id"]
+        
+        class RacingCollection:
+            async def find_one(self, *args, **kwargs):
+                key_doc = await test_db.api_keys.find_one(*args, **kwargs)
+                # delete_api_key runs while this lookup is in flight
+                await test_db.api_keys.delete_one({"_id": key_id})
+                invalidate_cached_api_key(key_id)
+                return key_doc
+            
+            def __getattr__(self, name):
+                return getattr(test_db.api_keys, name)
+        
+        class RacingDatabase:
+            api_keys = RacingCollection()
+        
+        monkeypatch.setattr("app.auth.get_database", RacingDatabase)
+        await get_current_api_key(credentials)
+        monkeypatch.undo()
+        
+        with pytest.raises(HTTPException) as exc_info:
+            await get_current_api_key(credentials)
+        
+        assert exc_info.value.status_code == 401
+    
+    async def test_key_deactivated_in_database_is_evicted(self, test_db, test_api_key):
+        """Test that a key deactivated outside the API stops authenticating once its change event arrives."""
+        credentials = HTTPAuthorizationCredentials(
+            scheme="Bearer",
+            credentials=test_api_key["key"]
+        )
+        
+        await get_current_api_key(credentials)
+        
+        key_id = test_api_key["data"]["_id"]
+        await test_db.api_keys.update_one({"_id": key_id}, {"$set": {"is_active": False}})
+        apply_api_key_change({
+            "operationType": "update",
+            "documentKey": {"_id": key_id},
+            "fullDocument": await test_db.api_keys.find_one({"_id": key_id})
+        })
+        
+        with pytest.raises(HTTPException) as exc_info:
+            await get_current_api_key(credentials)
+        
+        assert exc_info.value.status_code == 401
+    
+    def test_verify_api_key_dependency_valid(self, test_api_key):
+        """Test verify_api_key_dependency with valid API key."""
+        # The key document stands in for the resolved get_current_api_key result
+        api_key_data = test_api_key["data"]
+        result = verify_api_key_dependency(api_key_data)
         
         assert result is not None
         assert result["name"] == "Test API Key"
@@ -133,25 +310,10 @@ class TestAuthentication:
         
         assert exc_info.value.status_code == 401
     
-    async def test_multiple_api_keys(self, test_db):
+    async def test_multiple_api_keys(self, test_db, bulk_insert_keys):
         """Test authentication with multiple API keys."""
         # Create multiple API keys
-        keys = []
-        for i in range(3):
-            key = generate_api_key()
-            key_hash = hash_api_key(key)
-            
-            api_key_data = {
-                "name": f"Test API Key {i}",
-                "description": f"Test description {i}",
-                "is_active": True,
-                "key_hash": key_hash,
-                "created_at": datetime.utcnow(),
-                "last_used": None
-            }
-            
-            result = await test_db.api_keys.insert_one(api_key_data)
-            keys.append({"key": key, "id": result.inserted_id})
+        keys = await bulk_insert_keys(3)
         
         # Test that all keys work
         for i, key_data in enumerate(keys):
@@ -174,8 +336,9 @@ class TestAuthentication:
         result = await get_current_api_key(credentials)
         assert result is not None
         
-        # Delete the API key
+        # Delete the API key and drop it from the authentication cache
         await test_db.api_keys.delete_one({"_id": test_api_key["data"]["_id"]})
+        invalidate_cached_api_key(test_api_key["data"]["_id"])
         
         # Try to use the deleted key
         with pytest.raises(HTTPException) as exc_info:
@@ -191,24 +354,13 @@ class TestAuthentication:
             credentials=test_api_key["key"]
         )
         
-        # Simulate concurrent requests
-        import asyncio
-        
-        async def authenticate():
-            return await get_current_api_key(credentials)
-        
-        # Run multiple concurrent authentications
-        results = await asyncio.gather(
-            authenticate(),
-            authenticate(),
-            authenticate(),
-            return_exceptions=True
-        )
+        # Run multiple concurrent authentications; any failure fails the group
+        async with asyncio.TaskGroup() as tg:
+            tasks = [tg.create_task(get_current_api_key(credentials)) for _ in range(3)]
         
         # All should succeed
-        for result in results:
-            assert not isinstance(result, Exception)
-            assert result["name"] == "Test API Key"
+        for task in tasks:
+            assert task.result()["name"] == "Test API Key"
     
     async def test_api_key_case_sensitivity(self, test_db, test_api_key):
         """Test that API keys are case sensitive."""
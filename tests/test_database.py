@@ -1,5 +1,9 @@
 import pytest
-from app.database import get_database, connect_to_mongo, close_mongo_connection, mongodb
+import asyncio
+from pymongo import InsertOne, UpdateOne, DeleteOne
+from app.database import get_database, connect_to_mongo, close_mongo_connection, mongodb, apply_api_key_change, watch_api_keys, _api_key_cache
+from pymongo.errors import AutoReconnect, OperationFailure
+from bson import ObjectId
 from motor.motor_asyncio import AsyncIOMotorDatabase
 
 class TestDatabaseConnection:
@@ -10,6 +14,42 @@ class TestDatabaseConnection:
         db = get_database()
         assert isinstance(db, AsyncIOMotorDatabase)
     
+    async def test_connect_fails_when_email_index_cannot_be_built(self, test_db, monkeypatch):
+        """Test that startup fails instead of running without the unique email index."""
+        scratch = test_db.client["test_user_db_duplicate_emails"]
+        await scratch.users.insert_many([
+            {"name": "First", "email": "same@example.com"},
+            {"name": "Second", "email": "same@example.com"}
+        ])
+        monkeypatch.setattr("app.database.AsyncIOMotorClient", lambda *args, **kwargs: test_db.client)
+        monkeypatch.setattr("app.database.DATABASE_NAME", scratch.name)
+        
+        try:
+            with pytest.raises(OperationFailure):
+                await connect_to_mongo()
+            assert mongodb.api_key_watcher is None
+        finally:
+            await test_db.client.drop_database(scratch.name)
+            mongodb.database = test_db
+    
+    async def test_connect_fails_when_key_hash_index_cannot_be_built(self, test_db, monkeypatch):
+        """Test that startup fails instead of running without the unique key_hash index."""
+        scratch = test_db.client["test_user_db_duplicate_key_hashes"]
+        await scratch.api_keys.insert_many([
+            {"name": "First", "key_hash": "hash", "is_active": True},
+            {"name": "Second", "key_hash": "hash", "is_active": True}
+        ])
+        monkeypatch.setattr("app.database.AsyncIOMotorClient", lambda *args, **kwargs: test_db.client)
+        monkeypatch.setattr("app.database.DATABASE_NAME", scratch.name)
+        
+        try:
+            with pytest.raises(OperationFailure):
+                await connect_to_mongo()
+            assert mongodb.api_key_watcher is None
+        finally:
+            await test_db.client.drop_database(scratch.name)
+            mongodb.database = test_db
+    
     async def test_mongodb_singleton(self, test_db):
         """Test that mongodb is a singleton."""
         assert mongodb.database is not None
@@ -24,28 +64,16 @@ class TestDatabaseConnection:
         """Test basic database operations."""
         db = get_database()
         
-        # Test insert
-        test_doc = {"name": "test", "value": 123}
-        result = await db.test_collection.insert_one(test_doc)
-        assert result.inserted_id is not None
-        
-        # Test find
-        found_doc = await db.test_collection.find_one({"name": "test"})
-        assert found_doc is not None
-        assert found_doc["name"] == "test"
-        assert found_doc["value"] == 123
-        
-        # Test update
-        await db.test_collection.update_one(
-            {"name": "test"},
-            {"$set": {"value": 456}}
-        )
-        updated_doc = await db.test_collection.find_one({"name": "test"})
-        assert updated_doc["value"] == 456
-        
-        # Test delete
-        delete_result = await db.test_collection.delete_one({"name": "test"})
-        assert delete_result.deleted_count == 1
+        # Insert, update and delete in one round trip
+        result = await db.test_collection.bulk_write([
+            InsertOne({"name": "test", "value": 123}),
+            UpdateOne({"name": "test"}, {"$set": {"value": 456}}),
+            DeleteOne({"name": "test"})
+        ], ordered=True)
+        assert result.inserted_count == 1
+        assert result.matched_count == 1
+        assert result.modified_count == 1
+        assert result.deleted_count == 1
         
         # Verify deletion
         deleted_doc = await db.test_collection.find_one({"name": "test"})
@@ -61,32 +89,41 @@ class TestDatabaseConnection:
             "email": "test@email.com",
             "data_nascimento": "1990-01-01"
         }
-        result = await db.users.insert_one(user_doc)
-        assert result.inserted_id is not None
         
         # Test api_keys collection
         api_key_doc = {
-            "name": "Test API Key",
+            "name": "Collection Test Key",
             "key_hash": "test_hash",
             "is_active": True
         }
-        result = await db.api_keys.insert_one(api_key_doc)
-        assert result.inserted_id is not None
+        
+        # The two collections are independent, so insert into both concurrently
+        user_result, api_key_result = await asyncio.gather(
+            db.users.insert_one(user_doc),
+            db.api_keys.insert_one(api_key_doc)
+        )
+        assert user_result.inserted_id is not None
+        assert api_key_result.inserted_id is not None
         
         # Test finding documents
-        found_user = await db.users.find_one({"nome": "Test User"})
+        found_user, found_api_key = await asyncio.gather(
+            db.users.find_one({"nome": "Test User"}),
+            db.api_keys.find_one({"name": "Collection Test Key"})
+        )
         assert found_user is not None
-        
-        found_api_key = await db.api_keys.find_one({"name": "Test API Key"})
         assert found_api_key is not None
     
     async def test_database_indexes(self, test_db):
         """Test database indexes (if any)."""
         db = get_database()
         
-        # Test that we can create indexes
-        await db.users.create_index("email", unique=True)
-        await db.api_keys.create_index("key_hash")
+        # Indexes are created once per session by the indexed_db fixture
+        user_indexes, api_key_indexes = await asyncio.gather(
+            db.users.index_information(),
+            db.api_keys.index_information()
+        )
+        assert user_indexes["email_1"]["unique"] is True
+        assert api_key_indexes["key_hash_1"]["unique"] is True
         
         # Test unique constraint
         user1 = {"nome": "User 1", "email": "unique@email.com"}
@@ -108,7 +145,7 @@ class TestDatabaseConnection:
             {"nome": "User 2", "email": "user2@email.com", "age": 30},
             {"nome": "User 3", "email": "user3@email.com", "age": 35}
         ]
-        await db.users.insert_many(users)
+        await db.users.insert_many(users, ordered=False)
         
         # Test aggregation
         pipeline = [
@@ -116,38 +153,32 @@ class TestDatabaseConnection:
             {"$project": {"_id": 0, "avg_age": 1}}
         ]
         
-        result = []
-        async for doc in db.users.aggregate(pipeline):
-            result.append(doc)
+        result = await db.users.aggregate(pipeline).to_list(length=None)
         
         assert len(result) == 1
         assert result[0]["avg_age"] == 30.0
     
-    async def test_database_transactions(self, test_db):
+    async def test_database_transactions(self, test_db, is_replica_set):
         """Test database transactions (if supported)."""
-        db = get_database()
+        # Transactions require a replica set in MongoDB
+        if not is_replica_set:
+            pytest.skip("Transactions not supported in this MongoDB setup")
         
-        # Note: Transactions require a replica set in MongoDB
-        # This test demonstrates the transaction syntax
-        # but may not work in all test environments
+        db = get_database()
         
-        try:
-            async with mongodb.client.start_session() as session:
-                async with session.start_transaction():
-                    await db.users.insert_one(
-                        {"nome": "Transaction User", "email": "transaction@email.com"},
-                        session=session
-                    )
-                    
-                    # This should be part of the transaction
-                    user = await db.users.find_one(
-                        {"nome": "Transaction User"},
-                        session=session
-                    )
-                    assert user is not None
-        except Exception:
-            # Skip transaction test if not supported
-            pytest.skip("Transactions not supported in this MongoDB setup")
+        async with mongodb.client.start_session() as session:
+            async with session.start_transaction():
+                await db.users.insert_one(
+                    {"nome": "Transaction User", "email": "transaction@email.com"},
+                    session=session
+                )
+                
+                # This should be part of the transaction
+                user = await db.users.find_one(
+                    {"nome": "Transaction User"},
+                    session=session
+                )
+                assert user is not None
     
     async def test_database_error_handling(self, test_db):
         """Test database error handling."""
@@ -157,7 +188,72 @@ class TestDatabaseConnection:
         with pytest.raises(Exception):
             await db.invalid_collection.create_index({"invalid": "index"})
         
-        # Test invalid query
-        result = await db.users.find_one({"$invalid": "query"})
-        # Should return None, not raise an error
-        assert result is None
\ No newline at end of file
+        # Test invalid query operator is rejected by the server
+        with pytest.raises(Exception):
+            await db.users.find_one({"$invalid": "query"})
+
+class TestAPIKeyMap:
+    """Test the in-memory API key map kept current by the change stream."""
+    
+    def test_apply_api_key_change(self):
+        """Test that change events keep only active keys in the map."""
+        mongodb.api_key_map = {}
+        key_id = ObjectId()
+        doc = {"_id": key_id, "key_hash": "hash", "hash_algo": "blake3", "is_active": True}
+        
+        apply_api_key_change({"operationType": "insert", "documentKey": {"_id": key_id}, "fullDocument": doc})
+        assert mongodb.api_key_map == {"hash": doc}
+        
+        inactive_doc = {**doc, "is_active": False}
+        apply_api_key_change({"operationType": "update", "documentKey": {"_id": key_id}, "fullDocument": inactive_doc})
+        assert mongodb.api_key_map == {}
+        
+        apply_api_key_change({"operationType": "replace", "documentKey": {"_id": key_id}, "fullDocument": doc})
+        apply_api_key_change({"operationType": "delete", "documentKey": {"_id": key_id}})
+        assert mongodb.api_key_map == {}
+        
+        apply_api_key_change({"operationType": "insert", "documentKey": {"_id": key_id}, "fullDocument": doc})
+        apply_api_key_change({"operationType": "drop"})
+        assert mongodb.api_key_map == {}
+    
+    def test_apply_api_key_change_evicts_ttl_cache(self):
+        """Test that change events also evict the per-worker TTL cache."""
+        key_id = ObjectId()
+        _api_key_cache["hash"] = {"_id": key_id, "key_hash": "hash", "is_active": True}
+        
+        apply_api_key_change({"operationType": "delete", "documentKey": {"_id": key_id}})
+        assert "hash" not in _api_key_cache
+    
+    def test_apply_api_key_change_skips_legacy_hashes(self):
+        """Test that rows not yet rehashed to BLAKE3 stay out of the map."""
+        mongodb.api_key_map = {}
+        key_id = ObjectId()
+        doc = {"_id": key_id, "key_hash": "hash", "hash_algo": "sha256", "is_active": True}
+        
+        apply_api_key_change({"operationType": "insert", "documentKey": {"_id": key_id}, "fullDocument": doc})
+        assert mongodb.api_key_map == {}
+    
+    async def test_watch_api_keys_retries_after_error(self, monkeypatch):
+        """Test that a transient error restarts the change stream instead of ending the watcher."""
+        attempts = []
+        
+        class FailingCollection:
+            def watch(self, **kwargs):
+                attempts.append(kwargs)
+                if len(attempts) == 1:
+                    raise AutoReconnect("connection reset")
+                raise OperationFailure("$changeStream stage is only supported on replica sets", code=40573)
+        
+        class FakeDatabase:
+            api_keys = FailingCollection()
+        
+        async def no_sleep(delay):
+            pass
+        
+        monkeypatch.setattr(mongodb, "database", FakeDatabase())
+        monkeypatch.setattr("app.database.asyncio.sleep", no_sleep)
+        mongodb.api_key_map = {"hash": {}}
+        
+        await watch_api_keys()
+        assert len(attempts) == 2
+        assert mongodb.api_key_map == {}
\ No newline at end of file
@@ -7,23 +7,42 @@ from app.models import (
     APIKeyCreate, APIKeyUpdate, APIKeyResponse, APIKeyInDB,
     PyObjectId, generate_api_key, hash_api_key, verify_api_key
 )
+import blake3
+import hashlib
+import hmac
+
+# Expected digests computed once, independently of hash_api_key
+_KEY = "test_api_key"
+_KEY_HASH = blake3.blake3(_KEY.encode()).hexdigest()
+_KEY_SHA256 = hashlib.sha256(_KEY.encode()).hexdigest()
+
+# Fixed timestamp so model tests are deterministic
+_NOW = datetime(2024, 1, 1, 12, 0, 0)
+
+# Fixed id for assertions that only need some valid ObjectId
+SAMPLE_OID = ObjectId()
+
+@pytest.fixture
+def oid():
+    """Fresh ObjectId for tests that build a document around it."""
+    return ObjectId()
 
 class TestPyObjectId:
     """Test the custom PyObjectId class."""
     
-    def test_valid_objectid_string(self):
+    def test_valid_objectid_string(self, oid):
         """Test that valid ObjectId strings are accepted."""
-        valid_id = str(ObjectId())
+        valid_id = str(oid)
         py_id = PyObjectId.validate(valid_id)
         assert isinstance(py_id, ObjectId)
         assert str(py_id) == valid_id
     
-    def test_valid_objectid_instance(self):
+    def test_valid_objectid_instance(self, oid):
         """Test that ObjectId instances are accepted."""
-        original_id = ObjectId()
+        original_id = oid
         py_id = PyObjectId.validate(original_id)
         assert isinstance(py_id, ObjectId)
-        assert py_id == original_id
+        assert py_id is original_id
     
     def test_invalid_objectid_string(self):
         """Test that invalid ObjectId strings raise ValueError."""
@@ -32,7 +51,7 @@ class TestPyObjectId:
     
     def test_is_valid_check(self):
         """Test ObjectId.is_valid functionality."""
-        assert ObjectId.is_valid(str(ObjectId()))
+        assert ObjectId.is_valid(str(SAMPLE_OID))
         assert not ObjectId.is_valid("invalid")
 
 class TestUserModels:
@@ -50,32 +69,22 @@ class TestUserModels:
         assert user.email == "joao@email.com"
         assert user.data_nascimento == date(1990, 1, 15)
     
-    def test_user_create_invalid_email(self):
-        """Test UserCreate with invalid email."""
-        with pytest.raises(ValidationError):
-            UserCreate(
-                nome="João Silva",
-                email="invalid-email",
-                data_nascimento=date(1990, 1, 15)
-            )
-    
-    def test_user_create_empty_name(self):
-        """Test UserCreate with empty name."""
-        with pytest.raises(ValidationError):
-            UserCreate(
-                nome="",
-                email="joao@email.com",
-                data_nascimento=date(1990, 1, 15)
-            )
-    
-    def test_user_create_long_name(self):
-        """Test UserCreate with name too long."""
+    @pytest.mark.parametrize("field,value", [
+        ("email", "invalid-email"),
+        ("nome", ""),
+        ("nome", "x" * 101),  # Max is 100
+    ], ids=["invalid_email", "empty_name", "long_name"])
+    def test_user_create_invalid(self, field, value):
+        """Test UserCreate rejects an invalid email, an empty name and a name too long."""
+        user_data = {
+            "nome": "João Silva",
+            "email": "joao@email.com",
+            "data_nascimento": date(1990, 1, 15)
+        }
+        user_data[field] = value
+        
         with pytest.raises(ValidationError):
-            UserCreate(
-                nome="x" * 101,  # Max is 100
-                email="joao@email.com",
-                data_nascimento=date(1990, 1, 15)
-            )
+            UserCreate(**user_data)
     
     def test_user_update_partial(self):
         """Test UserUpdate with partial data."""
@@ -95,24 +104,22 @@ class TestUserModels:
         assert user_update.email == "joao.santos@email.com"
         assert user_update.data_nascimento == date(1985, 5, 20)
     
-    def test_user_response_with_objectid(self):
+    def test_user_response_with_objectid(self, oid):
         """Test UserResponse with ObjectId."""
-        obj_id = ObjectId()
         user_data = {
-            "_id": obj_id,
+            "_id": oid,
             "nome": "João Silva",
             "email": "joao@email.com",
             "data_nascimento": date(1990, 1, 15)
         }
         user = UserResponse(**user_data)
-        assert str(user.id) == str(obj_id)
+        assert str(user.id) == str(oid)
         assert user.nome == "João Silva"
     
-    def test_user_response_serialization(self):
+    def test_user_response_serialization(self, oid):
         """Test UserResponse serialization."""
-        obj_id = ObjectId()
         user_data = {
-            "_id": obj_id,
+            "_id": oid,
             "nome": "João Silva",
             "email": "joao@email.com",
             "data_nascimento": datetime(1990, 1, 15)
@@ -159,20 +166,19 @@ class TestAPIKeyModels:
         assert api_key_update.description is None
         assert api_key_update.is_active is None
     
-    def test_api_key_response_with_objectid(self):
+    def test_api_key_response_with_objectid(self, oid):
         """Test APIKeyResponse with ObjectId."""
-        obj_id = ObjectId()
         api_key_data = {
-            "_id": obj_id,
+            "_id": oid,
             "name": "Test API Key",
             "description": "Test description",
             "is_active": True,
             "key_preview": "abcd1234...wxyz",
-            "created_at": datetime.utcnow(),
+            "created_at": _NOW,
             "last_used": None
         }
         api_key = APIKeyResponse(**api_key_data)
-        assert str(api_key.id) == str(obj_id)
+        assert str(api_key.id) == str(oid)
         assert api_key.name == "Test API Key"
         assert api_key.key_preview == "abcd1234...wxyz"
 
@@ -192,29 +198,49 @@ class TestAPIKeyUtilities:
     
     def test_hash_api_key(self):
         """Test API key hashing."""
-        key = "test_api_key"
-        hash1 = hash_api_key(key)
-        hash2 = hash_api_key(key)
+        key_hash = hash_api_key(_KEY)
         
-        assert isinstance(hash1, str)
-        assert isinstance(hash2, str)
-        assert hash1 == hash2  # Same key should produce same hash
-        assert len(hash1) == 64  # SHA256 produces 64 char hex string
+        assert isinstance(key_hash, str)
+        assert key_hash == _KEY_HASH  # Same key should produce same hash
+        assert len(key_hash) == 64  # BLAKE3 produces 64 char hex string
+        assert hash_api_key(_KEY, "sha256") == _KEY_SHA256
     
     def test_verify_api_key_valid(self):
         """Test API key verification with valid key."""
-        key = "test_api_key"
-        key_hash = hash_api_key(key)
-        
-        assert verify_api_key(key, key_hash) is True
+        assert verify_api_key(_KEY, _KEY_HASH) is True
     
     def test_verify_api_key_invalid(self):
         """Test API key verification with invalid key."""
-        key = "test_api_key"
         wrong_key = "wrong_key"
-        key_hash = hash_api_key(key)
         
-        assert verify_api_key(wrong_key, key_hash) is False
+        assert verify_api_key(wrong_key, _KEY_HASH) is False
+    
+    def test_verify_api_key_timing_shape(self, monkeypatch):
+        """Test mismatches of any length go through the constant-time comparison."""
+        compared = []
+        compare_digest = hmac.compare_digest
+        
+        def spy(a, b):
+            compared.append((a, b))
+            return compare_digest(a, b)
+        
+        monkeypatch.setattr("app.models.hmac.compare_digest", spy)
+        
+        assert verify_api_key("a", _KEY_HASH) is False
+        assert verify_api_key("a" * 1024, _KEY_HASH) is False
+        # Both candidates are fixed-length digests compared against the stored hash
+        assert [len(a) for a, _ in compared] == [64, 64]
+    
+    def test_verify_api_key_precomputed_hash(self):
+        """Test API key verification with a hash computed by the caller."""
+        assert verify_api_key(_KEY, _KEY_HASH, precomputed_hash=_KEY_HASH) is True
+        assert verify_api_key(_KEY, _KEY_HASH, precomputed_hash=hash_api_key("wrong_key")) is False
+    
+    def test_verify_api_key_legacy_sha256(self):
+        """Test API key verification against a legacy SHA-256 hash."""
+        assert _KEY_SHA256 != _KEY_HASH
+        assert verify_api_key(_KEY, _KEY_SHA256, "sha256") is True
+        assert verify_api_key(_KEY, _KEY_SHA256) is False
     
     def test_hash_consistency(self):
         """Test that hash function is consistent."""